@@ -8,25 +8,27 @@ except ImportError as e:
     import sys
     sys.path.append("../")
 
+import os
 import unittest
 import numpy as np
 import tensorflow as tf
 
 from sionna.utils.metrics import BitErrorRate, BitwiseMutualInformation, compute_ber, compute_bler, count_block_errors, count_errors
-from sionna.fec.interleaving import RandomInterleaver
 from sionna.utils import sim_ber, complex_normal
 from sionna.fec.utils import GaussianPriorSource
 
-gpus = tf.config.list_physical_devices('GPU')
-print('Number of GPUs available :', len(gpus))
-if gpus:
-    gpu_num = 0 # Number of the GPU to be used
-    try:
-        tf.config.set_visible_devices(gpus[gpu_num], 'GPU')
-        print('Only GPU number', gpu_num, 'used.')
-        tf.config.experimental.set_memory_growth(gpus[gpu_num], True)
-    except Runtime as e:
-        print(e)
+# skip the GPU driver initialization if all GPUs are explicitly hidden
+if os.environ.get("CUDA_VISIBLE_DEVICES") != "":
+    gpus = tf.config.list_physical_devices('GPU')
+    print('Number of GPUs available :', len(gpus))
+    if gpus:
+        gpu_num = 0 # Number of the GPU to be used
+        try:
+            tf.config.set_visible_devices(gpus[gpu_num], 'GPU')
+            print('Only GPU number', gpu_num, 'used.')
+            tf.config.experimental.set_memory_growth(gpus[gpu_num], True)
+        except RuntimeError as e:
+            print(e)
 
 
 class ber_tester():
@@ -36,36 +38,59 @@ class ber_tester():
         self.shape = shape # shape
         self.errors = nb_errors # [1000, 400, 200, 100, 1, 0]
         self.idx = 0
+        self._flat_size = int(np.prod(self.shape))
+        self._zeros = tf.zeros(self.shape, dtype=tf.float32)
 
     def reset(self):
         self.idx = 0
 
+    def _error_pattern(self, idx):
+        """Flat pattern with ``self.errors[idx]`` ones at permuted positions.
+
+        The permutation is seeded by ``idx``, i.e., the pattern is fixed and
+        reproducible across testers and test runs."""
+        x = np.zeros(self._flat_size, dtype=np.float32)
+
+        # distribute nb_errors
+        x[:self.errors[idx]] = 1.
+
+        # permute
+        return np.random.default_rng(idx).permutation(x)
+
     def get_samples(self, batch_size, ebno_db):
         """Helper function to test sim_ber.
 
          Both inputs will be ignored but are required as placeholder to test
          sim_ber."""
 
-        nb_errors = self.errors[self.idx]
+        x = self._error_pattern(self.idx)
         # increase internal counter for next call
         self.idx += 1
-        x = np.zeros(np.prod(self.shape))
 
-        # distribute nb_errors
-        for i in range(nb_errors):
-            x[i] = 1
+        return self._zeros, tf.constant(x.reshape(self.shape))
 
-        # permute
-        interleaver = RandomInterleaver(axis=1, keep_batch_constant=False)
-        x = tf.expand_dims(x,0)
-        x = interleaver(x)
-        x = tf.reshape(x, self.shape)
+    def get_all_samples(self):
+        """Returns the samples of all SNR points at once.
 
-        return tf.zeros(self.shape), x
+         The error patterns are stacked along a new first dimension and equal
+         those returned by consecutive calls of get_samples."""
+        x = np.stack([self._error_pattern(i) for i in range(len(self.errors))])
+        x = x.reshape([len(self.errors)] + list(self.shape))
+
+        return self._zeros, tf.constant(x)
 
 
 class TestUtils(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        """Generate the error patterns shared by several tests only once."""
+        cls.errors = [1000, 400, 200, 100, 1, 0, 10]
+        cls.samples = {}
+        for shape in ([500, 20, 40], [50, 400]):
+            tester = ber_tester(cls.errors, shape)
+            cls.samples[tuple(shape)] = tester.get_all_samples()
+
     def test_ber_sim(self):
         """Test that ber_sim returns correct number of errors"""
 
@@ -93,98 +118,136 @@ class TestUtils(unittest.TestCase):
 
         # check that last ber is 0
         print(ber)
-        self.assertTrue(np.allclose(ber[-1], np.zeros_like(ber[-1])))
+        self.assertEqual(float(ber[-1]), 0.)
 
     def test_compute_ber(self):
         """Test that compute_ber returns the correct value."""
 
         shape = [500, 20, 40]
-        errors = [1000, 400, 200, 100, 1, 0, 10]
+        errors = self.errors
         bers_true = errors / np.prod(shape)
 
-        tester = ber_tester(errors, shape)
+        # XLA mode
+        @tf.function(jit_compile=True)
+        def compute_ber_xla(b, b_hat):
+            return compute_ber(b, b_hat)
 
-        for _,ber in enumerate(bers_true):
-            b, b_hat = tester.get_samples(0, 0)
+        b, b_hats = self.samples[tuple(shape)]
+        for idx,ber in enumerate(bers_true):
+            b_hat = b_hats[idx]
             ber_hat = compute_ber(b, b_hat)
-            self.assertTrue(np.allclose(ber, ber_hat))
+            self.assertAlmostEqual(ber, float(ber_hat))
+
+            # run same test for XLA (jit_compile=True)
+            ber_hat = compute_ber_xla(b, b_hat)
+            self.assertAlmostEqual(ber, float(ber_hat))
 
     def test_count_errors(self):
         """Test that count_errors returns the correct value."""
 
         shape = [500, 20, 40]
-        errors = [1000, 400, 200, 100, 1, 0, 10]
+        errors = self.errors
 
-        tester = ber_tester(errors, shape)
+        # XLA mode
+        @tf.function(jit_compile=True)
+        def count_errors_xla(b, b_hat):
+            return count_errors(b, b_hat)
 
-        for _,e in enumerate(errors):
-            b, b_hat = tester.get_samples(0, 0)
+        b, b_hats = self.samples[tuple(shape)]
+        for idx,e in enumerate(errors):
+            b_hat = b_hats[idx]
             errors_hat = count_errors(b, b_hat)
-            self.assertTrue(np.allclose(e, errors_hat))
+            self.assertEqual(e, int(errors_hat))
+
+            # run same test for XLA (jit_compile=True)
+            errors_hat = count_errors_xla(b, b_hat)
+            self.assertEqual(e, int(errors_hat))
 
     def test_count_block_errors(self):
         """Test that count_block_errors returns the correct value."""
 
         shape = [50, 400]
-        errors = [1000, 400, 200, 100, 1, 0, 10]
+        errors = self.errors
 
-        tester = ber_tester(errors, shape)
+        # XLA mode
+        @tf.function(jit_compile=True)
+        def count_block_errors_xla(b, b_hat):
+            return count_block_errors(b, b_hat)
 
-        for _,e in enumerate(errors):
-            b, b_hat = tester.get_samples(0, 0)
+        b, b_hats = self.samples[tuple(shape)]
+        for idx,e in enumerate(errors):
+            b_hat = b_hats[idx]
             bler_hat = count_block_errors(b, b_hat)
 
             # ground truth
-            bler = 0
-            for idx in range(shape[0]):
-                if not np.allclose(b[idx,:], b_hat[idx,:]):
-                    bler +=1
+            # (independent of the tested not_equal/reduce_any formulation)
+            bler = tf.reduce_max(tf.abs(b - b_hat), axis=1) > 0
+            bler = int(tf.reduce_sum(tf.cast(bler, tf.int32)))
+
+            self.assertEqual(bler, int(bler_hat))
 
-            self.assertTrue(np.allclose(bler, bler_hat))
+            # run same test for XLA (jit_compile=True)
+            bler_hat = count_block_errors_xla(b, b_hat)
+            self.assertEqual(bler, int(bler_hat))
 
     def test_compute_bler(self):
         """Test that compute_bler returns the correct value."""
 
         shape = [50, 400]
-        errors = [1000, 400, 200, 100, 1, 0, 10]
+        errors = self.errors
 
-        tester = ber_tester(errors, shape)
+        # XLA mode
+        @tf.function(jit_compile=True)
+        def compute_bler_xla(b, b_hat):
+            return compute_bler(b, b_hat)
 
-        for _,e in enumerate(errors):
-            b, b_hat = tester.get_samples(0, 0)
+        b, b_hats = self.samples[tuple(shape)]
+        for idx,e in enumerate(errors):
+            b_hat = b_hats[idx]
             bler_hat = compute_bler(b, b_hat)
 
             # ground truth
-            bler = 0
-            for idx in range(shape[0]):
-                if not np.allclose(b[idx,:], b_hat[idx,:]):
-                    bler +=1
+            # (independent of the tested not_equal/reduce_any formulation)
+            bler = tf.reduce_max(tf.abs(b - b_hat), axis=1) > 0
+            bler = int(tf.reduce_sum(tf.cast(bler, tf.int32)))
             bler /= shape[0]
-            self.assertTrue(np.allclose(bler, bler_hat))
+            self.assertAlmostEqual(bler, float(bler_hat))
+
+            # run same test for XLA (jit_compile=True)
+            bler_hat = compute_bler_xla(b, b_hat)
+            self.assertAlmostEqual(bler, float(bler_hat))
 
     def test_bit_error_metric(self):
         """Test that BitErrorRate metric returns the correct value."""
 
         shape = [500, 20, 40]
-        errors = [1000, 400, 200, 100, 1, 0, 10]
+        errors = self.errors
         bers_true = errors / np.prod(shape)
 
-        tester = ber_tester(errors, shape)
-
         ber_metric = BitErrorRate()
 
-        for idx,_ in enumerate(bers_true):
-            b, b_hat = tester.get_samples(0, 0)
+        @tf.function
+        def update_metric(b, b_hat):
             ber_metric(b, b_hat)
-            ber_hat = ber_metric.result()
-            self.assertTrue(np.allclose(np.mean(bers_true[:idx+1]),
-                                        ber_hat.numpy()))
+            return ber_metric.result()
+
+        # collect all results and transfer them at once
+        ber_hat = []
+        b, b_hats = self.samples[tuple(shape)]
+        for idx,_ in enumerate(bers_true):
+            b_hat = b_hats[idx]
+            ber_hat.append(update_metric(b, b_hat))
+        ber_hat = tf.stack(ber_hat).numpy()
+
+        # running mean of the true BERs
+        ber_mean = np.cumsum(bers_true) / np.arange(1, len(bers_true)+1)
+        self.assertTrue(np.allclose(ber_mean, ber_hat))
 
         # check that reset state also works
         ber_metric.reset_states()
-        self.assertTrue(ber_metric.result().numpy()==0.)
+        self.assertEqual(float(ber_metric.result()), 0.)
         # test that internal counter is 0
-        self.assertTrue(ber_metric.counter.numpy()==0.)
+        self.assertEqual(float(ber_metric.counter), 0.)
 
     def test_bmi_metric(self):
         """Test that BitwiseMutualInformation metric returns the correct value.
@@ -193,43 +256,94 @@ class TestUtils(unittest.TestCase):
         BMI.
         """
 
-        shape = [50000, 20, 40]
+        shape = [10000, 20, 40]
         bmis = np.arange(0.1, 0.9, 0.1)
 
         bmi_metric = BitwiseMutualInformation()
         source = GaussianPriorSource(specified_by_mi=True)
+        b = tf.zeros(shape)
 
-        for idx, bmi in enumerate(bmis):
+        @tf.function
+        def update_metric(bmi):
             # generate fake llrs with given bmi
             llr = source([shape, bmi])
-            b = tf.zeros_like(llr)
-            # update metric
             bmi_metric(b, llr)
+            return bmi_metric.result()
 
-            self.assertTrue(np.allclose(np.mean(bmis[:idx+1]),
-                                        bmi_metric.result().numpy(),
-                                        rtol=0.01))
+        # collect all results and transfer them at once
+        bmi_hat = []
+        for bmi in bmis:
+            bmi_hat.append(update_metric(tf.constant(bmi, tf.float32)))
+        bmi_hat = tf.stack(bmi_hat).numpy()
+
+        # running mean of the true BMIs
+        bmi_mean = np.cumsum(bmis) / np.arange(1, len(bmis)+1)
+        self.assertTrue(np.allclose(bmi_mean, bmi_hat, rtol=0.01))
 
         # check that reset state also works
         bmi_metric.reset_states()
-        self.assertTrue(bmi_metric.result().numpy()==0.)
+        self.assertEqual(float(bmi_metric.result()), 0.)
         # test that internal counter is 0
-        self.assertTrue(bmi_metric.counter.numpy()==0.)
+        self.assertEqual(float(bmi_metric.counter), 0.)
 
 
 
 class TestComplexNormal(unittest.TestCase):
     """Test cases for the complex_normal function"""
+    def _estimate_var(self, batch_stats, batch_size, num_batches):
+        """Estimates the variance of the real and imaginary parts from
+        ``num_batches`` calls of ``batch_stats``, each returning the mean and
+        sum of squared deviations of a batch of ``batch_size`` samples.
+
+        The statistics of the individual batches are merged with the parallel
+        variant of Welford's algorithm, such that only a single batch needs to
+        be kept in memory."""
+        k = batch_size
+        n = 0
+        mean = np.zeros([2])
+        m2 = np.zeros([2])
+        for _ in range(num_batches):
+            # only the batch statistics are transferred to the host
+            mean_b, m2_b = batch_stats().numpy()
+            delta = mean_b - mean
+            n += k
+            mean += delta*k/n
+            m2 += m2_b + delta**2*k*(n-k)/n
+        return m2/n
+
     def test_variance(self):
-        shape = [100000000]
+        # 100 batches of 1e6 samples, i.e., 1e8 samples in total
+        shape = [1000000]
+        num_batches = 100
+
+        def moments(x):
+            # mean and sum of squared deviations of real and imaginary parts
+            x = tf.stack([tf.math.real(x), tf.math.imag(x)])
+            x = tf.cast(x, tf.float64)
+            mean = tf.reduce_mean(x, axis=-1)
+            m2 = tf.reduce_sum(tf.square(x - mean[:,tf.newaxis]), axis=-1)
+            return tf.stack([mean, m2])
+
+        # var is passed as tensor to trace the function only once
+        @tf.function(input_signature=[tf.TensorSpec([], tf.float32)])
+        def batch_stats(var):
+            return moments(complex_normal(shape, var))
+
+        @tf.function
+        def batch_stats_default():
+            return moments(complex_normal(shape))
+
         v = [0, 0.5, 1.0, 2.3, 25]
         for var in v:
-            x = complex_normal(shape, var)
-            self.assertTrue(np.allclose(var, np.var(x), rtol=1e-3))
-            self.assertTrue(np.allclose(np.var(np.real(x)), np.var(np.imag(x)), rtol=1e-3))
+            var_t = tf.constant(var, tf.float32)
+            var_real, var_imag = self._estimate_var(lambda: batch_stats(var_t),
+                                                    shape[0], num_batches)
+            self.assertTrue(np.allclose(var, var_real+var_imag, rtol=1e-3))
+            self.assertTrue(np.allclose(var_real, var_imag, rtol=1e-3))
 
         # Default variance
-        var_hat = np.var(complex_normal(shape))
+        var_hat = np.sum(self._estimate_var(batch_stats_default,
+                                            shape[0], num_batches))
         self.assertTrue(np.allclose(1.0, var_hat, rtol=1e-3))
 
     def test_dtype(self):
@@ -248,17 +362,27 @@ class TestComplexNormal(unittest.TestCase):
             self.assertEqual(d, x.shape)
 
     def test_xla(self):
-        @tf.function(jit_compile=True)
-        def func(batch_size, var):
-            return complex_normal([batch_size, 1000], var, tf.complex128)
-        var = 0.3
-        var_hat = np.var(func(100000, var))
-        self.assertTrue(np.allclose(var, var_hat, rtol=1e-3))
-
-        var = 1
-        var_hat = np.var(func(100000, var))
-        self.assertTrue(np.allclose(var, var_hat, rtol=1e-3))
-
-        var = tf.cast(0.3, tf.int32)
-        var_hat = np.var(func(100000, var))
-        self.assertTrue(np.allclose(var, var_hat, rtol=1e-3))
+        def get_func(dtype):
+            @tf.function(jit_compile=True)
+            def func(batch_size, var):
+                return complex_normal([batch_size, 1000], var, dtype)
+            return func
+
+        # the complex128 path is tested with a 10x smaller batch size and,
+        # thus, a larger tolerance (the relative standard error of the
+        # variance estimate is 1/sqrt(batch_size*1000))
+        for dtype, batch_size, rtol in [(tf.complex64, 100000, 1e-3),
+                                        (tf.complex128, 10000, 3e-3)]:
+            func = get_func(dtype)
+
+            var = 0.3
+            var_hat = np.var(func(batch_size, var))
+            self.assertTrue(np.allclose(var, var_hat, rtol=rtol))
+
+            var = 1
+            var_hat = np.var(func(batch_size, var))
+            self.assertTrue(np.allclose(var, var_hat, rtol=rtol))
+
+            var = tf.cast(0.3, tf.int32)
+            var_hat = np.var(func(batch_size, var))
+            self.assertTrue(np.allclose(var, var_hat, rtol=rtol))